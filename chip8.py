@@ -1,24 +1,52 @@
 import random
 
+# Bits of the opcode that select the instruction within each family, where it isn't just the top nibble
+FAMILY_MASKS = {0x0000: 0xFFFF, 0x8000: 0xF00F, 0xF000: 0xF0FF}
+
+# Operand fields of every possible opcode, so decoding looks them up instead of masking and shifting
+X = tuple((opcode & 0x0F00) >> 8 for opcode in range(0x10000))
+Y = tuple((opcode & 0x00F0) >> 4 for opcode in range(0x10000))
+N = tuple(opcode & 0x000F for opcode in range(0x10000))
+NN = tuple(opcode & 0x00FF for opcode in range(0x10000))
+NNN = tuple(opcode & 0x0FFF for opcode in range(0x10000))
+
+# Every sprite byte drawn at every bit offset within a display byte, split into the (left, right) display bytes it covers
+SPRITE_HALVES = tuple(tuple((sprite >> shift, (sprite << (8 - shift)) & 0xFF) for sprite in range(256)) for shift in range(8))
+
+# Characters that the binary digits of a display row render as
+PIXELS = str.maketrans('01', ' █')
+
+# Mask off the operands of an opcode, leaving the key of its instruction
+def instruction_key(opcode):
+    return opcode & FAMILY_MASKS.get(opcode & 0xF000, 0xF000)
+
 class Chip8:
+    # Fixed attribute set, so assigning to a misspelt attribute raises instead of quietly creating a new field
+    __slots__ = ('ram', 'V', 'I', 'pc', 'stack', 't_delay', 't_sound', 'display',
+                 'clock_speed', 'clock', 'rtc_mod', '_rand8', 'trace',
+                 'instructions', 'dispatch', 'handlers', 'operands', '_decoded')
+
     def __init__(self, rom):
-        self.ram = [0x0] * 4096  # 4K ram (12 bit addresses)
-        self.V = [0x0] * 16      # 8 bit registers
+        self.ram = bytearray(4096) # 4K ram (12 bit addresses)
+        self.V = bytearray(16)     # 8 bit registers
         self.I = 0x0             # 16 bit GP register
         self.pc = 0x200          # 16 bit program counter
 
-        self.stack = [None] * 16 # Callstack - default None just to better highlight errors
-        self.sp = 0x0            # Stack pointer
+        self.stack = []          # Callstack of up to 16 return addresses
 
         self.t_delay = 0x0       # 8 bit delay register
         self.t_sound = 0x0       # 8 bit sound register
 
-        self.display = [0x0] * (64 * 32) # Monochrome display
+        self.display = bytearray(64 * 32 // 8) # Monochrome display, 8 pixels per byte with the leftmost in the high bit
 
         self.clock_speed = 512
         self.clock = 0
         self.rtc_mod = self.clock_speed // 60
 
+        self._rand8 = random.Random().getrandbits # Called with 8 for a random byte in CXNN
+
+        self.trace = False # Print each opcode and the registers after it as it executes (ignored under python -O)
+
         self.load_rom(rom)
 
         # Font
@@ -41,53 +69,88 @@ class Chip8:
             0xF0, 0x80, 0xF0, 0x80, 0x80  # F
         ]
 
+        # Handler for each instruction, and the operand fields it takes
         self.instructions = {
-            0x1000: self.op_1NNN,
-            0x2000: self.op_2NNN,
-            0x3000: self.op_3XNN,
-            0x4000: self.op_4XNN,
-            0x5000: self.op_5XY0,
-            0x6000: self.op_6XNN,
-            0x7000: self.op_7XNN,
-            0x8000: self.op_8000,
-            0xA000: self.op_ANNN,
-            0xB000: self.op_BNNN,
-            0xC000: self.op_CXNN,
-            0xD000: self.op_DXYN,
-            0xF000: self.op_F000,
+            0x00EE: (self.op_00EE, ()),
+            0x1000: (self.op_1NNN, (NNN,)),
+            0x2000: (self.op_2NNN, (NNN,)),
+            0x3000: (self.op_3XNN, (X, NN)),
+            0x4000: (self.op_4XNN, (X, NN)),
+            0x5000: (self.op_5XY0, (X, Y)),
+            0x6000: (self.op_6XNN, (X, NN)),
+            0x7000: (self.op_7XNN, (X, NN)),
+            0x8000: (self.op_8XY0, (X, Y)),
+            0x8001: (self.op_8XY1, (X, Y)),
+            0x8002: (self.op_8XY2, (X, Y)),
+            0x8003: (self.op_8XY3, (X, Y)),
+            0x8004: (self.op_8XY4, (X, Y)),
+            0x8005: (self.op_8XY5, (X, Y)),
+            0xA000: (self.op_ANNN, (NNN,)),
+            0xB000: (self.op_BNNN, (NNN,)),
+            0xC000: (self.op_CXNN, (X, NN)),
+            0xD000: (self.op_DXYN, (X, Y, N)),
+            0xF029: (self.op_FX29, (X,)),
+            0xF033: (self.op_FX33, (X,)),
+            0xF055: (self.op_FX55, (X,)),
+            0xF065: (self.op_FX65, (X,)),
         }
 
-    # Emulate overflow and underflow
-    def _8bit(self, val):
-        return val % 256
-
-    def _16bit(self, val):
-        return val % 65536
-
-    def hex_str(self, val):
-        return '{:02X}'.format(val)
+        # Handler and operand fields for every possible opcode, so decoding is a single tuple index
+        unknown = (self._op_unknown, ())
+        self.dispatch = tuple(self.instructions.get(instruction_key(opcode), unknown) for opcode in range(0x10000))
+
+        # Decode cache: handler and operands of the instruction starting at each address.
+        # Anything that writes to ram must call _invalidate to keep it in sync.
+        self.handlers = [None] * 4096
+        self.operands = [None] * 4096
+        self._decoded = {} # (handler, operands) by opcode, shared by every address holding that opcode
+        for pc in range(4096):
+            self._decode(pc)
+
+    def _op_unknown(self):
+        pc = (self.pc - 2) & 0xFFF # pc has already moved past this instruction
+        opcode = self.ram[pc] << 8 | self.ram[(pc + 1) & 0xFFF]
+        raise ValueError('Unknown opcode 0x{:04X} at 0x{:03X}'.format(opcode, pc))
+
+    # Split the instruction at pc into its handler and operand fields, and store them in the decode cache
+    def _decode(self, pc):
+        opcode = self.ram[pc] << 8 | self.ram[(pc + 1) & 0xFFF]
+        decoded = self._decoded.get(opcode)
+        if decoded is None:
+            handler, fields = self.dispatch[opcode]
+            decoded = self._decoded[opcode] = (handler, tuple(field[opcode] for field in fields))
+        self.handlers[pc], self.operands[pc] = decoded
+
+    # Write bytes to ram starting at ptr, wrapping round past the end of ram, and re-decode the instructions they overlap
+    def _store(self, ptr, data):
+        for offset, byte in enumerate(data):
+            self.ram[(ptr + offset) & 0xFFF] = byte
+        self._invalidate(ptr, ptr + len(data))
+
+    # Re-decode every instruction overlapping ram[start:end] after it has been written to
+    def _invalidate(self, start, end):
+        for pc in range(start - 1, end):
+            self._decode(pc & 0xFFF)
 
     # Pretty-print a memory dump for debugging
     def print_mem(self, arr):
-        s = ''
-        for ptr in range(len(arr)):
-            if ptr % 64 == 0:
-                s += '0x{:03X}: '.format(ptr)
-            s += self.hex_str(arr[ptr])
-            s += '\n' if ptr % 64 == 63 else ' '
-        print(s)
+        hexed = bytes(arr).hex(' ').upper() # 3 characters per byte, including the separator
+        print('\n'.join('0x{:03X}: {}'.format(ptr, hexed[ptr * 3:(ptr + 64) * 3 - 1]) for ptr in range(0, len(arr), 64)))
 
     # Execute a full clock cycle
     def _cycle_clock(self):
         self.clock += 1
 
-        # Read two bytes from memory, little endian
-        opcode = self.ram[self.pc] << 8 | self.ram[self.pc + 1]
-        print('0x{:04X}'.format(opcode))
+        pc = self.pc
+        if __debug__ and self.trace:
+            print('0x{:04X}'.format(self.ram[pc] << 8 | self.ram[(pc + 1) & 0xFFF]))
 
-        # print(self.instructions[opcode & 0xF000])
-        self.instructions[opcode & 0xF000](opcode) # Mask opcode, get associated function, and execute
-        self.pc += 2 # Increment program counter to next instruction
+        # Move to the next instruction before executing, so jumps and calls land exactly where they point
+        self.pc = (pc + 2) & 0xFFF
+        self.handlers[pc](*self.operands[pc]) # Execute the predecoded instruction
+
+        if __debug__ and self.trace:
+            self.print_mem(self.V)
 
         if self.clock % self.rtc_mod == 0:
             if self.t_delay > 0:
@@ -95,134 +158,158 @@ class Chip8:
             if self.t_sound > 0:
                 self.t_sound -= 1
 
+    # Run clock cycles until an instruction fails, with the hot state bound to locals.
+    # pc stays on self since handlers jump and skip by writing to it.
+    # Cycles run in batches of rtc_mod between timer ticks, keeping the timer check out of the inner loop.
+    def run(self):
+        if __debug__ and self.trace: # Tracing is all I/O anyway, so just single step
+            while True:
+                self._cycle_clock()
+
+        handlers = self.handlers
+        operands = self.operands
+        rtc_mod = self.rtc_mod
+        batch = range(rtc_mod)
+        cycle = -1
+        try:
+            while True:
+                for cycle in batch:
+                    pc = self.pc
+                    self.pc = (pc + 2) & 0xFFF
+                    handlers[pc](*operands[pc])
+                self.clock += rtc_mod
+                cycle = -1 # The batch is counted, so nothing is left over if we're interrupted before the next one
+
+                if self.t_delay > 0:
+                    self.t_delay -= 1
+                if self.t_sound > 0:
+                    self.t_sound -= 1
+        except BaseException:
+            self.clock += cycle + 1 # Count the partial batch, including the instruction that raised
+            raise
+
     # Render to the display in text format to a string
     def render_display(self):
-        pix = {1: '█', 0: ' '}
-        disp = ''
-        for i in range(64 * 32):
-            disp += pix[self.display[i]]
-            if i % 64 == 63:
-                disp += '\n'
-        return disp
+        # Each 8 byte row of the display is formatted as one 64 digit binary number
+        rows = [format(int.from_bytes(self.display[ptr:ptr + 8], 'big'), '064b') for ptr in range(0, len(self.display), 8)]
+        return ('\n'.join(rows) + '\n').translate(PIXELS)
 
     # Load a rom from a binary file into memory, starting at memory address 0x200 (512)
-    # TODO: Check that this actually works, little/big endian error likely here
     def load_rom(self, rom):
-        f = open(rom, 'rb')
-        ptr = 0x200
-        with open(rom, 'rb'):
-            while True:
-                byte = f.read(1)
-                if not byte:
-                    break
-                self.ram[ptr] = int.from_bytes(byte, 'big')
-                ptr += 1
+        with open(rom, 'rb') as f:
+            data = f.read()
+        if len(data) > len(self.ram) - 0x200:
+            raise ValueError('{} is {} bytes, too big to fit in ram'.format(rom, len(data)))
+        self.ram[0x200:0x200 + len(data)] = data
 
     ##### INSTRUCTION SET #####
     # https://en.wikipedia.org/wiki/CHIP-8#Opcode_table for more details
-    def op_1NNN(self, opcode):  # Goto NNN
-        self.pc = opcode & 0x0FFF
-
-    def op_2NNN(self, opcode):  # Call subroutine
-        self.stack[self.sp] = self.pc # Place current location on the stack so we can go back to it later
-        self.pc = opcode & 0x0FFF
-
-    def op_3XNN(self, opcode):  # Skip next instruction if Vx == NN
-        Vx = self.V[(opcode & 0x0F00) >> 8]
-        if Vx == (opcode & 0x00FF):
-            self.pc += 2  # Skip next instruction
-
-    def op_4XNN(self, opcode):  # Skip next instruction if Vx != NN
-        Vx = self.V[(opcode & 0x0F00) >> 8]
-        if Vx != (opcode & 0x00FF):
-            self.pc += 2
-
-    def op_5XY0(self, opcode):  # Skip next instruction if Vx == Vy
-        Vx = self.V[(opcode & 0x0F00) >> 8]
-        Vy = self.V[(opcode & 0x00F0) >> 4]
-        if Vx == Vy:
-            self.pc += 2
-
-    def op_6XNN(self, opcode):  # Set Vx to NN
-        # print('V:', (opcode & 0x0F00) >> 8, (opcode & 0x00FF))
-        self.V[(opcode & 0x0F00) >> 8] = (opcode & 0x00FF)
-
-    def op_7XNN(self, opcode):  # Increment Vx by NN
-        self.V[(opcode & 0x0F00) >> 8] = self._8bit(self.V[(opcode & 0x0F00) >> 8] + (opcode & 0x00FF))
-
-    # Determine which 8*** opcode to execute by masking off 8XY*
-    def op_8000(self, opcode):
-        {0x8000: self.op_8XY0, 0x8001: self.op_8XY1, 0x8002: self.op_8XY2, 0x8003: self.op_8XY3, 0x8004: self.op_8XY4, 0x8005: self.op_8XY5}[opcode & 0xF00F](opcode)
-
-    def op_8XY0(self, opcode):  # Set Vx to value of Vy
-        self.V[(opcode & 0x0F00) >> 8] = self.V[(opcode & 0x00F0) >> 4]
-
-    def op_8XY1(self, opcode):  # Bitwise OR, Vx=Vx|Vy
-        self.V[(opcode & 0x0F00) >> 8] = self.V[(opcode & 0x0F00) >> 8] | self.V[(opcode & 0x00F0) >> 4]
-
-    def op_8XY2(self, opcode):  # Bitwise AND, Vx=Vx&Vy
-        self.V[(opcode & 0x00F0) >> 4] = self.V[(opcode & 0x0F00) >> 8] & self.V[(opcode & 0x00F0) >> 4]
-
-    def op_8XY3(self, opcode):  # Bitwise XOR, Vx=Vx&Vy
-        self.V[(opcode & 0x00F0) >> 4] = self.V[(opcode & 0x0F00) >> 8] ^ self.V[(opcode & 0x00F0) >> 4]
-
-    def op_8XY4(self, opcode):  # Vx = Vx + Vy, set VF to 1 if overflow
-        sum = self.V[(opcode & 0x0F00) >> 8] + self.V[(opcode & 0x00F0) >> 4]
-        self.V[0xF] = int(sum > 0xFFFF)
-        self.V[(opcode & 0x0F00) >> 8] = self._8bit(sum)
-
-    def op_8XY5(self, opcode):  # Vx = Vy - Vx, set VF to 1 if NO underflow
-        sub = self.V[(opcode & 0x0F00) >> 8] + self.V[(opcode & 0x00F0) >> 4]
-        self.V[0xF] = int(sub > 0x0000)
-        self.V[(opcode & 0x0F00) >> 8] = self._8bit(sum)
-
-    def op_ANNN(self, opcode): self.I = (opcode & 0x0FFF)  # Set I to NNN
-    def op_BNNN(self, opcode): self.pc = self.V[0] + (opcode & 0x0FFF) # Not really sure what this is for
-    def op_CXNN(self, opcode): self.V[(opcode & 0x0F00) >> 8] = random.randint(0, 255) & (opcode & 0x00FF) # Random number and mask with NN
-
-    # Draw a sprite starting at (X, Y) with width 8 and height N, using bits starting from address I.
-    def op_DXYN(self, opcode):
-        x0 = opcode & 0x0F00
-        y0 = opcode & 0x00F0
-        h = opcode & 0x000F
-        ptr = self.I
-        for y_offset in range(h):
-            row = [int(i) for i in '{0:08b}'.format(self.ram[ptr])] # Get 8 bits as separate integers
-            y = y0 + y_offset
-            self.display[y * 64 + x0:y + 64 + x0 + 8] = row
-            ptr += 1
-
-    # Determine which F*** opcode to execute by masking off FX**
-    def op_F000(self, opcode):
-        {0x29: self.op_FX29, 0x33: self.op_FX33, 0x55: self.op_FX55, 0x65: self.op_FX65}[opcode & 0x00FF](opcode)
-
-    def op_FX29(self, opcode):
-        Vx = self.V[(opcode & 0x0F00) >> 8]
+    # Handlers take just the operand fields named in their opcode, in order
+    def op_00EE(self):  # Return from subroutine
+        if not self.stack:
+            raise ValueError('Return with an empty callstack at 0x{:03X}'.format((self.pc - 2) & 0xFFF))
+        self.pc = self.stack.pop()
+
+    def op_1NNN(self, nnn):  # Goto NNN
+        self.pc = nnn
+
+    def op_2NNN(self, nnn):  # Call subroutine
+        if len(self.stack) == 16: # CHIP-8 only has room for 16 return addresses
+            raise ValueError('Callstack overflow at 0x{:03X}'.format((self.pc - 2) & 0xFFF))
+        self.stack.append(self.pc) # Place the return address on the stack so we can go back to it later
+        self.pc = nnn
+
+    def op_3XNN(self, x, nn):  # Skip next instruction if Vx == NN
+        if self.V[x] == nn:
+            self.pc = (self.pc + 2) & 0xFFF  # Skip next instruction
+
+    def op_4XNN(self, x, nn):  # Skip next instruction if Vx != NN
+        if self.V[x] != nn:
+            self.pc = (self.pc + 2) & 0xFFF
+
+    def op_5XY0(self, x, y):  # Skip next instruction if Vx == Vy
+        if self.V[x] == self.V[y]:
+            self.pc = (self.pc + 2) & 0xFFF
+
+    def op_6XNN(self, x, nn):  # Set Vx to NN
+        self.V[x] = nn
+
+    def op_7XNN(self, x, nn):  # Increment Vx by NN
+        self.V[x] = (self.V[x] + nn) & 0xFF # Wraps round, VF is left alone
+
+    def op_8XY0(self, x, y):  # Set Vx to value of Vy
+        self.V[x] = self.V[y]
+
+    def op_8XY1(self, x, y):  # Bitwise OR, Vx=Vx|Vy
+        self.V[x] = self.V[x] | self.V[y]
+
+    def op_8XY2(self, x, y):  # Bitwise AND, Vx=Vx&Vy
+        self.V[x] = self.V[x] & self.V[y]
+
+    def op_8XY3(self, x, y):  # Bitwise XOR, Vx=Vx^Vy
+        self.V[x] = self.V[x] ^ self.V[y]
+
+    def op_8XY4(self, x, y):  # Vx = Vx + Vy, set VF to 1 if overflow
+        total = self.V[x] + self.V[y]
+        self.V[x] = total & 0xFF
+        self.V[0xF] = total >> 8 # Carry out of the 8 bit result
+
+    def op_8XY5(self, x, y):  # Vx = Vx - Vy, set VF to 1 if NO underflow
+        diff = self.V[x] - self.V[y]
+        self.V[x] = diff & 0xFF
+        self.V[0xF] = int(diff >= 0)
+
+    def op_ANNN(self, nnn): self.I = nnn  # Set I to NNN
+    def op_BNNN(self, nnn): self.pc = (self.V[0] + nnn) & 0xFFF # Not really sure what this is for
+    def op_CXNN(self, x, nn): self.V[x] = self._rand8(8) & nn # Random number and mask with NN
+
+    # Draw a sprite starting at (Vx, Vy) with width 8 and height N, using bits starting from address I.
+    # Each sprite row is XORed straight into the packed display, touching at most two bytes. VF is set on collision.
+    def op_DXYN(self, x, y, n):
+        x0 = self.V[x] & 63
+        col = x0 >> 3
+        shift = x0 & 7
+        halves = SPRITE_HALVES[shift]
+        row = (self.V[y] & 31) * 8 # Offset of the row's first byte in the display
+        display = self.display
+        collision = 0
+        sprite_rows = self.ram[self.I:self.I + n]
+        if len(sprite_rows) < n: # Sprite runs past the end of ram, so wraps round like _store
+            sprite_rows += self.ram[:n - len(sprite_rows)]
+        for sprite in sprite_rows:
+            bits, spill = halves[sprite]
+            left = row + col
+            collision |= display[left] & bits
+            display[left] ^= bits
+            if shift: # Sprite isn't byte aligned, so the rest of it spills into the next byte (wrapping round the row)
+                right = row + ((col + 1) & 7)
+                collision |= display[right] & spill
+                display[right] ^= spill
+            row = (row + 8) & 0xFF # Next row down, wrapping from the bottom of the screen to the top
+        self.V[0xF] = int(collision != 0)
+
+    def op_FX29(self, x):
+        Vx = self.V[x]
         if Vx > 0xF:
             raise ValueError('0xFX29 with {} out of bounds'.format(Vx))
-        self.ram[self.I:self.I + 4] = self.ram[Vx * 4:(Vx + 1) * 4]
-
-    def op_FX33(self, opcode):  # Convert Vx to BCD, store in 3 bytes starting at I
-        Vx = self.V[(opcode & 0x0F00) >> 8]
-        self.ram[self.I + 0] = Vx // 100
-        self.ram[self.I + 1] = (Vx % 100) // 10
-        self.ram[self.I + 2] = Vx % 10
-
-    def op_FX55(self, opcode):  # Copy V0-Vx to ram, beginning at I
-        V_slice = self.V[:((opcode & 0x0F00) >> 8) + 1]
-        self.ram[self.I:self.I + len(V_slice)] = V_slice
-
-    def op_FX65(self, opcode):  # Copy x values from ram starting at I to V0-Vx
-        x = (opcode & 0x0F00) >> 8
-        ram_slice = self.ram[self.I:self.I + x + 1]
-        self.V[:x + 1] = ram_slice
-
-cpu = Chip8('pong.rom')
-cpu.print_mem(cpu.ram)
-try:
-    while True:
-        cpu._cycle_clock()
-        cpu.print_mem(cpu.V)
-except:
+        self._store(self.I, self.ram[Vx * 4:(Vx + 1) * 4])
+
+    def op_FX33(self, x):  # Convert Vx to BCD, store in 3 bytes starting at I
+        hundreds, rest = divmod(self.V[x], 100)
+        tens, ones = divmod(rest, 10)
+        self._store(self.I, (hundreds, tens, ones))
+
+    def op_FX55(self, x):  # Copy V0-Vx to ram, beginning at I
+        self._store(self.I, self.V[:x + 1])
+
+    def op_FX65(self, x):  # Copy x values from ram starting at I to V0-Vx
+        self.V[:x + 1] = bytes(self.ram[(self.I + offset) & 0xFFF] for offset in range(x + 1)) # Wraps like _store
+
+if __name__ == '__main__':
+    cpu = Chip8('pong.rom')
     cpu.print_mem(cpu.ram)
-    raise
+    try:
+        cpu.run()
+    except:
+        cpu.print_mem(cpu.ram)
+        raise